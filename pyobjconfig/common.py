@@ -8,23 +8,27 @@ as ML_MODEL_BATCH_SIZE.  Useful primarily for dataset locations.
 """
 
 import enum
-import functools
 import os
 import pydantic
-import re
+import pydantic_core
 import sys
+import typing
+import weakref
 
 missing = {}
 
-def _init_wrapper(fn):
-    @functools.wraps(fn)
-    def inner(self, *args, **kwargs):
-        if 'child_configurables' not in kwargs:
-            raise ValueError("Do not create a ConfigurableObject directly; "
-                    "instead, use Class.argparse_create(dict)")
-        return fn(self, *args, **kwargs)
-    return inner
+# Fallback storage for parsed docstring help, for config classes which do not
+# accept new class attributes.
+_help_props_fallback = weakref.WeakKeyDictionary()
 
+def _argv_flag_map():
+    """One pass over ``sys.argv``, mapping ``--flag value`` pairs to
+    ``{'flag': 'value'}``.  Lets switches sniff their chosen option with a
+    dict lookup instead of a linear argv scan apiece.
+    """
+    argv = sys.argv
+    return {argv[i][2:]: argv[i + 1] for i in range(len(argv) - 1)
+            if argv[i].startswith('--')}
 
 class ConfigurableObject:
     """Leaning heavily on `pydantic`, create a configurable hierarchy of
@@ -41,28 +45,147 @@ class ConfigurableObject:
     config_defaults = None
     config_hparams_extra = None
 
-    @_init_wrapper
-    def __init__(self, *, config, child_configurables):
+    @classmethod
+    def _config_fields(cls):
+        """Memoized ``cls.config.model_fields`` -- pydantic v2 keeps field
+        info as a plain class attribute, so unlike ``schema()`` there is no
+        JSON-schema build to pay for; the memoization covers the one-time
+        validation and the derived key set.
+
+        Checked via ``cls.__dict__`` so subclasses (e.g. from
+        ``with_defaults``) do not inherit a stale cache.
+        """
+        fields = cls.__dict__.get('_config_fields_cache')
+        if fields is None:
+            # Validated here, once per class, so the setup/create paths need
+            # not re-check on every traversal.
+            assert issubclass(cls.config, pydantic.BaseModel)
+            fields = cls.config.model_fields
+            cls._config_fields_cache = fields
+            cls._config_keys_cache = frozenset(
+                    k for k in fields if not k.startswith('_'))
+        return fields
+
+
+    @classmethod
+    def _config_keys(cls):
+        """Frozenset of non-underscore field names from `_config_fields`.
+        """
+        if cls.__dict__.get('_config_fields_cache') is None:
+            cls._config_fields()
+        return cls.__dict__['_config_keys_cache']
+
+
+    @classmethod
+    def _child_configurables(cls):
+        """Memoized tuple of ``(name, child_cls)`` for class attributes which
+        are themselves `ConfigurableObject` subclasses.  ``dir()`` +
+        ``getattr`` walk the whole MRO per attribute; do that once per class
+        rather than on every setup/create traversal.
+        """
+        children = cls.__dict__.get('_child_cfg_cache')
+        if children is None:
+            children = tuple((k, v) for k in dir(cls)
+                    for v in [getattr(cls, k)]
+                    if isinstance(v, type) and issubclass(v, ConfigurableObject))
+            cls._child_cfg_cache = children
+            cls._child_names_cache = frozenset(k for k, _ in children)
+        return children
+
+
+    @classmethod
+    def _child_names(cls):
+        """Frozenset of the names from `_child_configurables`."""
+        if cls.__dict__.get('_child_cfg_cache') is None:
+            cls._child_configurables()
+        return cls.__dict__['_child_names_cache']
+
+
+    @classmethod
+    def _help_props(cls):
+        """Help text per property, parsed from the config class docstring
+        (``:param name: blah`` entries).  Docstrings are immutable, so parse
+        once per config class and memoize on it.
+        """
+        config = cls.config
+        props = config.__dict__.get('_help_props_cache')
+        if props is None:
+            props = _help_props_fallback.get(config)
+        if props is not None:
+            return props
+
+        props = {}
+        docs = config.__doc__
+        if docs is not None:
+            last_name = None
+            last_prop = None
+            def finalize():
+                nonlocal last_name, last_prop
+                if last_name is not None:
+                    props[last_name] = '\n'.join(last_prop)
+                    last_name = None
+                    last_prop = None
+            for line in docs.split('\n'):
+                # The grammar is trivial (spaces/tabs, ':param ', identifier,
+                # ':'), so a hand-rolled scan beats the regex engine.
+                name = None
+                s = line.lstrip(' \t')
+                if s.startswith(':param '):
+                    ident = s[7:]
+                    i = 0
+                    while i < len(ident) and (
+                            ident[i].isalnum() or ident[i] == '_'):
+                        i += 1
+                    if i and i < len(ident) and ident[i] == ':':
+                        name = ident[:i]
+                if name is None:
+                    if not line or line.isspace():
+                        finalize()
+                    elif last_name is not None:
+                        last_prop.append(line)
+                else:
+                    finalize()
+                    last_name = name
+                    last_prop = [ident[i + 1:]]
+            finalize()
+
+        try:
+            config._help_props_cache = props
+        except (AttributeError, TypeError):
+            _help_props_fallback[config] = props
+        return props
+
+    def __init__(self, *, config, child_configurables=missing):
+        # The sentinel default stands in for the old wrapper's check, without
+        # an extra call frame per instantiation.
+        if child_configurables is missing:
+            raise ValueError("Do not create a ConfigurableObject directly; "
+                    "instead, use Class.argparse_create(dict)")
         # Overwrite class-based method
         if self.config is not None:
             # Invoke pydantic validation, etc
-            extra_keys = set(config.keys()).difference(
-                    self.config.schema()['properties'].keys())
+            # Dict-view set difference against the cached frozenset avoids
+            # materializing an intermediate set per object creation.
+            extra_keys = config.keys() - self._config_keys()
             try:
                 if extra_keys:
                     raise ValueError(f'Extra keys: {extra_keys}')
                 self.config = self.config(**config)
-            except:
-                raise ValueError(f'During {self.config} init from {config}')
+            except Exception as e:
+                raise ValueError(
+                        f'During {self.config} init from {config}') from e
         elif config:
             raise ValueError(f'Extra keys: {config.keys()}')
 
         self.config_hparams_extra = {}
+        # Dispatch against the cached child names rather than a
+        # getattr/issubclass pair per child (both walk the MRO).
+        child_names = self._child_names()
         for k, v in child_configurables.items():
             if isinstance(v, _ConfigurableChildWithExtraHparams):
                 setattr(self, k, v.value)
                 self.config_hparams_extra.update(v.hparams)
-            elif issubclass(getattr(self, k), ConfigurableObject):
+            elif k in child_names:
                 setattr(self, k, v)
             else:
                 raise NotImplementedError(getattr(self, k))
@@ -80,7 +203,14 @@ class ConfigurableObject:
     def argparse_create(cls, args, env=None):
         # Copy args and get rid of "unspecified" values.
         args = {k: v for k, v in args.items() if v is not None}
-        r = cls._argparse_create(env, '', args)
+        # Snapshot the relevant environment variables once, rather than
+        # building a canonical name and probing os.environ per field.
+        env_map = None
+        if env is not None:
+            env_canon = f'{env}_'.upper().replace('-', '_')
+            env_map = {k: v for k, v in os.environ.items()
+                    if k.startswith(env_canon)}
+        r = cls._argparse_create(env, '', args, env_map)
         assert not args, args
         return r
 
@@ -89,17 +219,36 @@ class ConfigurableObject:
     def argparse_setup(cls, parser):
         # Force exact matches only when specifying arguments
         parser.allow_abbrev = False
-        cls._argparse_setup('', parser)
+        # Collect every argument spec first, then register them in one tight
+        # loop; parser.add_argument carries real per-call overhead.
+        specs = []
+        cls._collect_argspecs('', specs, _argv_flag_map())
+        for name, help, kw in specs:
+            parser.add_argument(f'--{name}', dest=name, help=help, **kw)
 
 
     def argparse_hparams(self):
+        # Iterative traversal rather than recursion; enum values are mapped
+        # inline so `settings` is built in final form in one pass.
         settings = {}
-        self._argparse_hparams(self, '', settings)
-        def m(v):
-            if isinstance(v, enum.Enum):
-                return v.value
-            return v
-        settings = {k: m(v) for k, v in settings.items()}
+        stack = [(self, '')]
+        while stack:
+            obj, prefix = stack.pop()
+            if obj.config is not None:
+                for k in type(obj)._config_fields():
+                    if k.startswith('_'): continue
+                    v = getattr(obj.config, k)
+                    settings[f'{prefix}{k}'] = (
+                            v.value if isinstance(v, enum.Enum) else v)
+            for k, v in obj.config_hparams_extra.items():
+                if k in settings:
+                    raise ValueError(f'Duplicate key {repr(k)}?')
+                settings[k] = v.value if isinstance(v, enum.Enum) else v
+            # __dict__ OK, as we want instance-only properties.  Push in
+            # reverse so the LIFO stack pops siblings in definition order.
+            for k, v in reversed(obj.__dict__.items()):
+                if isinstance(v, ConfigurableObject) and v is not self:
+                    stack.append((v, prefix + k + '-'))
         return settings
 
 
@@ -110,137 +259,145 @@ class ConfigurableObject:
             assert len(args) == 1, 'Args must be a single dict'
             default_vals.update(args[0])
         default_vals.update(kwargs)
+        # Creating a type is comparatively expensive (new dict, new MRO, and
+        # interpreter caches invalidated); reuse the subclass when the same
+        # defaults are requested again.
+        try:
+            # Keyed on value types too, since e.g. True == 1 but the two
+            # produce different config_defaults.
+            key = frozenset((k, type(v), v) for k, v in default_vals.items())
+        except TypeError:
+            # Unhashable default values; cannot key a cache off them.
+            key = None
+        if key is not None:
+            cache = cls.__dict__.get('_with_defaults_cache')
+            if cache is None:
+                cache = weakref.WeakValueDictionary()
+                cls._with_defaults_cache = cache
+            sub = cache.get(key)
+            if sub is None:
+                sub = type(cls.__name__ + 'WithDefaults', (cls,),
+                        {'config_defaults': default_vals})
+                cache[key] = sub
+            return sub
         return type(cls.__name__ + 'WithDefaults', (cls,),
                 {'config_defaults': default_vals})
 
 
     @classmethod
-    def _argparse_check_env(cls, env_prefix, prefix, k, args):
-        """If {prefix}{k} exists in environment (upper-case), set that value
-        on ``args`` if it doesn't already exist.
+    def _collect_argspecs(cls, prefix, specs, argv_flags=None):
+        """Append ``(name, help, add_argument_kwargs)`` for this subtree to
+        ``specs``.  Note that help messages grabbed from config class
+        docstring, using format :param i: blah.
         """
-        if env_prefix is None:
+        children = cls._child_configurables()
+        if cls.config is None and not children:
+            # Leaf without config; nothing to register, and no reason to
+            # touch pydantic at all.
             return
-
-        argname = f'{prefix}{k}'
-        name = f'{env_prefix}_{prefix}{k}'.upper().replace('-', '_')
-        v = os.environ.get(name)
-        if v is not None:
-            args.setdefault(argname, v)
-
-
-    @classmethod
-    def _argparse_setup(cls, prefix, parser):
-        """Note that help messages grabbed from config class docstring,
-        using format :param i: blah.
-        """
         if cls.config is not None:
-            assert issubclass(cls.config, pydantic.BaseModel)
-
-            docs = cls.config.__doc__
-            props = {}
-            if docs is not None:
-                last_name = None
-                last_prop = None
-                def finalize():
-                    nonlocal last_name, last_prop
-                    if last_name is not None:
-                        props[last_name] = '\n'.join(last_prop)
-                        last_name = None
-                        last_prop = None
-                for line in docs.split('\n'):
-                    m = re.search(r'^[ \t]*:param ([a-zA-Z0-9_]+):', line)
-                    if m is None:
-                        if not line.strip():
-                            finalize()
-                        elif last_name is not None:
-                            last_prop.append(line)
-                    else:
-                        finalize()
-                        last_name = m.group(1)
-                        last_prop = [line[m.end():]]
-                finalize()
-
-            for k, v in cls.config.schema()['properties'].items():
+            props = cls._help_props()
+            for k, field in cls._config_fields().items():
                 if k.startswith('_'): continue
                 name = f'{prefix}{k}'
                 help = props.get(k) or ''
-                if 'default' in v:
-                    help = help + f'  Default: {v["default"]}'
+                if (not field.is_required() and field.default
+                        is not pydantic_core.PydanticUndefined):
+                    # default_factory fields report is_required() False but
+                    # leave .default as the undefined sentinel; keep that out
+                    # of user-facing help.  Enum defaults show their value,
+                    # which is the form the CLI accepts.
+                    d = field.default
+                    if isinstance(d, enum.Enum):
+                        d = d.value
+                    help = help + f'  Default: {d}'
                 kw = {}
-                if v.get('type') == 'array' and v.get('items', {}).get('type') == 'string':
+                ann = field.annotation
+                is_array = typing.get_origin(ann) in (list, tuple, set)
+                item_types = typing.get_args(ann)
+                if is_array and item_types and item_types[0] is str:
                     # To allow strings with a comma, do NOT use comma-separated
                     # for this.
                     kw['action'] = 'append'
                 else:
                     # Rely on pydantic type conversion
-                    v_field = cls.config.__fields__[k]
-                    def convert_str_to_type(arg, *, v=v, v_field=v_field):
-                        if v.get('type') == 'array':
+                    adapter = pydantic.TypeAdapter(ann)
+                    def convert_str_to_type(arg, *, is_array=is_array,
+                            adapter=adapter):
+                        if is_array:
                             # Convert to comma-separated-list; 1-d only
                             if arg.startswith('['):
                                 assert arg.endswith(']')
                                 arg = arg[1:-1]
                             arg = arg.split(',')
-                        return pydantic.parse_obj_as(v_field.outer_type_, arg)
+                        return adapter.validate_python(arg)
                     kw['type'] = convert_str_to_type
-                parser.add_argument(f'--{name}', dest=name, help=help, **kw)
-        for k in dir(cls):
-            v = getattr(cls, k)
-            if type(v) is type and issubclass(v, ConfigurableObject):
-                v._argparse_setup(prefix + k + '-', parser)
-
-
-    def _argparse_hparams(self, root, prefix, hparams):
-        if self.config is not None:
-            for k in self.config.schema()['properties'].keys():
-                if k.startswith('_'): continue
-                docname = f'{prefix}{k}'
-                hparams[docname] = getattr(self.config, k)
-        for k, v in self.config_hparams_extra.items():
-            if k in hparams:
-                raise ValueError(f'Duplicate key {repr(k)}?')
-            hparams[k] = v
-        # __dict__ OK, as we want instance-only properties
-        for k, v in self.__dict__.items():
-            if isinstance(v, ConfigurableObject) and v is not root:
-                v._argparse_hparams(root, prefix + k + '-', hparams)
+                specs.append((name, help, kw))
+        for k, v in children:
+            v._collect_argspecs(prefix + k + '-', specs, argv_flags)
 
 
     @classmethod
-    def _argparse_create(cls, env_prefix, prefix, args):
+    def _argparse_create(cls, env_prefix, prefix, args, env_map=None):
+        """``args`` holds only the keys for this level of the tree, with
+        ``prefix`` already stripped; nested args are partitioned by their
+        first ``-`` segment and handed to the matching child.  ``prefix`` is
+        kept for error messages and environment-variable names.
+        """
+        # Canonical environment-variable prefix for this level, built once
+        # rather than per field.
+        env_base = None
+        if env_map:
+            env_base = f'{env_prefix}_{prefix}'.upper().replace('-', '_')
         if cls.config_defaults is not None:
             for k, v in cls.config_defaults.items():
-                # Overwrite values in args which were not set.
-                cls._argparse_check_env(env_prefix, prefix, k, args)
-                args.setdefault(f'{prefix}{k}', v)
+                # Overwrite values in args which were not set; environment
+                # takes precedence over the class default.
+                if k not in args:
+                    ev = (env_map.get(env_base + k.upper().replace('-', '_'))
+                            if env_map else None)
+                    args[k] = v if ev is None else ev
                 # TODO I believe this is currently broken if a with_defaults()
                 # is nested within another with_defaults().
         config = {}
         post_init = {}
         if cls.config is not None:
-            assert issubclass(cls.config, pydantic.BaseModel)
-            for k in cls.config.schema()['properties'].keys():
+            for k in cls._config_fields().keys():
                 if k.startswith('_'): continue
-                docname = f'{prefix}{k}'
-                v = args.pop(docname, None)
-                if v is None:
+                v = args.pop(k, None)
+                if v is None and env_map:
                     # Check environment if wasn't specified otherwise
-                    cls._argparse_check_env(env_prefix, prefix, k, args)
-                    v = args.pop(docname, None)
+                    v = env_map.get(env_base + k.upper())
                 if v is not None:
                     config[k] = v
-        for k in dir(cls):
-            v = getattr(cls, k)
-            if type(v) is type and issubclass(v, ConfigurableObject):
+        children = cls._child_configurables()
+        if children:
+            # One pass over args to group nested keys by child, rather than
+            # each descendant popping prefixed names out of a shared flat
+            # dict.
+            groups = {}
+            for key in [kk for kk in args if '-' in kk]:
+                head, _, rest = key.partition('-')
+                groups.setdefault(head, {})[rest] = args.pop(key)
+            for k, v in children:
+                sub = groups.pop(k, None)
+                if sub is None:
+                    sub = {}
+                if k in args and issubclass(v, _ConfigurableSwitchImpl):
+                    # A switch's own choice lives at this level, unprefixed.
+                    sub[''] = args.pop(k)
                 post_init[k] = v._argparse_create(env_prefix, prefix + k + '-',
-                        args)
-        try:
-            r = cls(config=config, child_configurables=post_init)
-        except:
-            raise TypeError(cls)
+                        sub, env_map)
+                # Anything the child did not consume bubbles back up under
+                # its full name, so the top-level leftover check reports it.
+                for kk, vv in sub.items():
+                    args[f'{k}-{kk}'] = vv
+            for head, g in groups.items():
+                for kk, vv in g.items():
+                    args[f'{head}-{kk}'] = vv
+        r = cls(config=config, child_configurables=post_init)
         if r.config is not None:
-            for k, v in r.config.dict().items():
+            for k, v in r.config.model_dump().items():
                 if v is None:
                     raise ValueError(f'Cannot leave parameters as `None`, as '
                             f' that would break json serialization: '
@@ -249,6 +406,8 @@ class ConfigurableObject:
 
 
 class _ConfigurableChildWithExtraHparams:
+    __slots__ = ('value', 'hparams')
+
     def __init__(self, value, hparams):
         self.value = value
         self.hparams = hparams
@@ -274,9 +433,11 @@ class _ConfigurableSwitchImpl(ConfigurableObject):
                 Obj.argparse_create({'choice': 'a', 'choice-option': 99})
     """
 
-    # These two overwritten by the `ConfigurableSwitch` method.
+    # These overwritten by the `ConfigurableSwitch` method.
     _options = None
     _default = missing
+    _keys_repr = None
+    _help_suffix = None
 
     @property
     def v(self):
@@ -288,15 +449,16 @@ class _ConfigurableSwitchImpl(ConfigurableObject):
 
 
     @classmethod
-    def _argparse_create(cls, env_prefix, prefix, args):
+    def _argparse_create(cls, env_prefix, prefix, args, env_map=None):
         choice = cls._default
 
         # `prefix` has hyphen; remove it
         choicename = prefix[:-1]
-        v = args.pop(choicename, None)
-        if v is None:
-            cls._argparse_check_env(env_prefix, choicename, '', args)
-            v = args.pop(choicename, None)
+        # The parent stashes the unprefixed choice under ''.
+        v = args.pop('', None)
+        if v is None and env_map:
+            v = env_map.get(
+                    f'{env_prefix}_{choicename}'.upper().replace('-', '_'))
         if v is not None:
             choice = v
 
@@ -305,58 +467,53 @@ class _ConfigurableSwitchImpl(ConfigurableObject):
 
         value = cls._get_option(choice)
         if type(value) is type and issubclass(value, ConfigurableObject):
-            value = value._argparse_create(env_prefix, prefix, args)
+            value = value._argparse_create(env_prefix, prefix, args, env_map)
 
         return _ConfigurableChildWithExtraHparams(value,
                 {choicename: choice})
 
 
-    def _argparse_hparams(self, root, prefix, hparams):
-        raise NotImplementedError("Shouldn't be called")
-
-
     @classmethod
-    def _argparse_setup(cls, prefix, parser):
+    def _collect_argspecs(cls, prefix, specs, argv_flags=None):
         name = prefix[:-1]
 
         # The tricky part -- figure out which switch has been requested, and
         # give help.
-        choice_current = cls._default
-        try:
-            idx = sys.argv.index(f'--{name}')
-            choice_current = sys.argv[idx+1]
-        except ValueError:
-            pass
+        if argv_flags is None:
+            argv_flags = _argv_flag_map()
+        choice_current = argv_flags.get(name, cls._default)
         choice_name = 'no option'
         if choice_current is not missing:
             choice_name = repr(choice_current)
 
-        # Now add help
-        help = (f"Inferred {choice_name}; help shown corresponds to that "
-                f"option. "
-                f"Switch accepting: {repr(list(cls._options.keys()))}.")
-        if cls._default is not missing:
-            help += f' Default: {repr(cls._default)}.'
-        help += (f' Pass another option to see available '
-                f'arguments for that option.')
-        parser.add_argument(f'--{name}', dest=name, help=help)
+        # Now add help; only the inferred choice varies, the rest was built
+        # once in `ConfigurableSwitch`.
+        help = f'Inferred {choice_name};' + cls._help_suffix
+        specs.append((name, help, {}))
 
         if choice_current is not missing:
             value = cls._get_option(choice_current)
             if type(value) is type and issubclass(value, ConfigurableObject):
-                value._argparse_setup(prefix, parser)
+                value._collect_argspecs(prefix, specs, argv_flags)
 
 
     @classmethod
     def _get_option(cls, choice):
-        try:
-            value = cls._options[choice]
-        except KeyError:
-            raise KeyError(f'Wanted {repr(choice)}; valid options: {list(cls._options.keys())}')
+        value = cls._options.get(choice, missing)
+        if value is missing:
+            raise KeyError(f'Wanted {repr(choice)}; valid options: {cls._keys_repr}')
         return value
 
 
 def ConfigurableSwitch(options, default: str=missing):
+    keys_repr = repr(list(options.keys()))
+    help_suffix = (f" help shown corresponds to that option. "
+            f"Switch accepting: {keys_repr}.")
+    if default is not missing:
+        help_suffix += f' Default: {repr(default)}.'
+    help_suffix += (f' Pass another option to see available '
+            f'arguments for that option.')
     return type('ConfigurableSwitch_Custom', (_ConfigurableSwitchImpl,),
-            {'_options': options, '_default': default})
+            {'_options': options, '_default': default,
+                '_keys_repr': keys_repr, '_help_suffix': help_suffix})
 
@@ -12,8 +12,24 @@ class ConfigurableModule(ConfigurableObject, torch.nn.Module):
         ConfigurableObject.__init__(self, *args, **kwargs)
 
     def __setattr__(self, name, value):
-        torch.nn.Module.__setattr__(self, name, value)
-        object.__setattr__(self, name, value)
+        if (isinstance(value, (torch.nn.Module, torch.nn.Parameter,
+                    torch.Tensor))
+                or value is None
+                or name in self.__dict__.get('_parameters', ())
+                or name in self.__dict__.get('_buffers', ())
+                or name in self.__dict__.get('_modules', ())):
+            # Anything torch may track -- modules, parameters, tensors
+            # (which may target a registered buffer), None clearing a
+            # registered name, or any already-tracked name -- must go through
+            # torch's machinery so _modules/_parameters/_buffers stay
+            # consistent.  Also keep it in __dict__ so the configuration
+            # traversal can see it.
+            torch.nn.Module.__setattr__(self, name, value)
+            object.__setattr__(self, name, value)
+        else:
+            # Genuinely untracked plain values do not need torch's
+            # per-assignment type dispatch.
+            object.__setattr__(self, name, value)
 
 
     def state_restore(self, d):
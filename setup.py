@@ -14,6 +14,6 @@ setuptools.setup(
         long_description_content_type='text/markdown',
         url='https://github.com/wwoods/pyobjconfig',
         packages=setuptools.find_packages(),
-        install_requires=['pydantic'],
+        install_requires=['pydantic>=2'],
 )
 